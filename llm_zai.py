@@ -1,12 +1,556 @@
 """LLM plugin for Z.ai's GLM models."""
 
+import asyncio
+import atexit
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
 import llm
 from llm import hookimpl
 from llm import KeyModel, AsyncKeyModel
-import httpx
-from typing import Optional, Dict, Any, List
+from typing import TYPE_CHECKING, Optional, Dict, Any, List
 from pydantic import Field
 
+if TYPE_CHECKING:
+    import httpx
+
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    _json_loads = orjson.loads
+except ImportError:  # Fall back to stdlib if orjson is unavailable
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _json_loads = json.loads
+
+
+# Shared clients so repeated requests reuse pooled keep-alive connections
+# instead of paying a fresh TCP + TLS handshake per call. Created lazily on
+# first use so merely importing (or registering) the plugin stays cheap:
+# httpx itself is only imported once a client is actually needed, keeping it
+# off the `llm` CLI startup path entirely.
+_CLIENT_LIMITS_KWARGS = dict(
+    max_keepalive_connections=10,
+    max_connections=20,
+    keepalive_expiry=90,
+)
+
+# Client-level timeouts: fail fast on stalled connects but leave reads
+# unbounded so long streamed completions are never aborted mid-stream.
+# Non-streaming requests override this per call with a bounded read.
+_CLIENT_TIMEOUT_KWARGS = dict(connect=5.0, read=None, write=10.0, pool=5.0)
+
+# Headers identical for every request; set once on the shared clients so the
+# per-request headers carry only Authorization.
+_STATIC_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}
+
+
+@functools.lru_cache(maxsize=4)
+def _headers_for_key(api_key: str) -> Dict[str, str]:
+    """Authorization header dict, shared across model instances per key.
+
+    All ten registered model instances resolve the same key, so the
+    formatted dict is built once; the tiny cache bound tolerates key
+    rotation without growing.
+    """
+    return {"Authorization": f"Bearer {api_key}"}
+
+_sync_client: Optional["httpx.Client"] = None
+
+# Async clients are pinned to the event loop that created them: an
+# AsyncClient used from a different loop raises "attached to a different
+# loop", which bites servers that run one loop per worker. Keyed weakly so
+# a torn-down loop lets its client be collected.
+_async_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _get_client() -> "httpx.Client":
+    """Get (lazily creating) the shared sync client."""
+    global _sync_client
+    if _sync_client is None:
+        import httpx
+
+        _sync_client = httpx.Client(
+            http2=True,
+            headers=_STATIC_HEADERS,
+            timeout=httpx.Timeout(**_CLIENT_TIMEOUT_KWARGS),
+            limits=httpx.Limits(**_CLIENT_LIMITS_KWARGS),
+        )
+        atexit.register(_sync_client.close)
+    return _sync_client
+
+
+def _get_async_client() -> "httpx.AsyncClient":
+    """Get (lazily creating) the pooled async client for the running loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import httpx
+
+        client = httpx.AsyncClient(
+            http2=True,
+            headers=_STATIC_HEADERS,
+            timeout=httpx.Timeout(**_CLIENT_TIMEOUT_KWARGS),
+            limits=httpx.Limits(**_CLIENT_LIMITS_KWARGS),
+        )
+        _async_clients[loop] = client
+    return client
+
+# Optional aiohttp backend for high-concurrency async traffic, selected with
+# ZAI_HTTP_BACKEND=aiohttp. Requires the aiohttp extra; httpx stays the
+# default. Sessions are pinned per event loop like the httpx clients.
+_aiohttp_sessions: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _use_aiohttp() -> bool:
+    return os.environ.get("ZAI_HTTP_BACKEND") == "aiohttp"
+
+
+def _get_aiohttp_session():
+    """Get (lazily creating) the pooled aiohttp session for the running loop."""
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _aiohttp_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100, ttl_dns_cache=300, keepalive_timeout=90
+            ),
+            # Mirror the httpx timeout design: stalled connects fail fast,
+            # reads stay unbounded so long streamed completions are never
+            # aborted mid-flight. Non-streaming requests bound the read
+            # per call.
+            timeout=aiohttp.ClientTimeout(total=None, connect=5.0, sock_connect=5.0),
+            headers=_STATIC_HEADERS,
+        )
+        _aiohttp_sessions[loop] = session
+    return session
+
+
+async def aclose():
+    """Close the shared async clients (for explicit lifecycle teardown)."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+    session = _aiohttp_sessions.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+try:
+    import msgspec
+
+    class _Delta(msgspec.Struct):
+        content: Optional[str] = None
+        reasoning_content: Optional[str] = None
+
+    class _Choice(msgspec.Struct):
+        delta: _Delta = msgspec.field(default_factory=_Delta)
+
+    class _StreamChunk(msgspec.Struct):
+        choices: List[_Choice] = msgspec.field(default_factory=list)
+        usage: Optional[Dict[str, Any]] = None
+
+    _CHUNK_DECODER = msgspec.json.Decoder(_StreamChunk)
+except ImportError:  # msgspec is an optional extra; fall back to dicts
+    _CHUNK_DECODER = None
+
+
+def _parse_stream_payload(data: bytes):
+    """(content delta, usage) from an SSE payload; usage is usually None.
+
+    Uses the typed msgspec decoder when available, which parses straight into
+    C structs instead of Python dicts; falls back to plain JSON otherwise.
+    The usage-bearing final chunk arrives with an empty choices list.
+    """
+    if _CHUNK_DECODER is not None:
+        try:
+            chunk = _CHUNK_DECODER.decode(data)
+        except msgspec.DecodeError:
+            return "", None
+        if not chunk.choices:
+            return "", chunk.usage
+        delta = chunk.choices[0].delta
+        return delta.content or delta.reasoning_content or "", chunk.usage
+    try:
+        chunk = _json_loads(data)
+    except ValueError:
+        # Skip malformed payloads, matching the msgspec path above. Both
+        # orjson and stdlib json raise ValueError subclasses here.
+        return "", None
+    choices = chunk.get("choices")
+    if not choices:
+        return "", chunk.get("usage")
+    delta = choices[0].get("delta", {})
+    return (
+        delta.get("content") or delta.get("reasoning_content") or "",
+        chunk.get("usage"),
+    )
+
+
+# SSE framing constants for the bytes-level stream parser.
+_DATA_PREFIX = b"data: "
+_DONE_MARKER = b"[DONE]"
+
+
+def _iter_sse_data(byte_chunks):
+    """Yield the payload bytes of each SSE data line from a bytes stream.
+
+    Works on raw bytes with a single reusable buffer, avoiding the per-line
+    unicode decode and string slicing of iter_lines(). Each completed line
+    starts at offset 0 of the buffer, so the data: prefix is checked and the
+    payload sliced out in place - one allocation per yielded payload.
+    Stops at [DONE].
+    """
+    buffer = bytearray()
+    for chunk in byte_chunks:
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline < 0:
+                break
+            end = newline
+            if end > 0 and buffer[end - 1] == 0x0D:  # trailing \r
+                end -= 1
+            if end > 6 and buffer.startswith(_DATA_PREFIX):
+                data = bytes(buffer[6:end])
+                del buffer[: newline + 1]
+                if data == _DONE_MARKER:
+                    return
+                yield data
+            else:
+                del buffer[: newline + 1]
+
+
+async def _aiter_sse_data(byte_chunks):
+    """Async variant of _iter_sse_data."""
+    buffer = bytearray()
+    async for chunk in byte_chunks:
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline < 0:
+                break
+            end = newline
+            if end > 0 and buffer[end - 1] == 0x0D:  # trailing \r
+                end -= 1
+            if end > 6 and buffer.startswith(_DATA_PREFIX):
+                data = bytes(buffer[6:end])
+                del buffer[: newline + 1]
+                if data == _DONE_MARKER:
+                    return
+                yield data
+            else:
+                del buffer[: newline + 1]
+
+
+# Built message history per conversation, keyed weakly so entries vanish
+# with the conversation. Values are (responses_seen, messages_prefix).
+_HISTORY_CACHE: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+# Options consumed by the plugin itself and never sent to the API.
+_INTERNAL_OPTIONS = frozenset({"stream", "stream_batch_ms"})
+
+# Coalescing bounds for streamed chunks: flush whenever this many fragments
+# or this many characters have accumulated, or the configured time window
+# has elapsed.
+_STREAM_BATCH_CHUNKS = 8
+_STREAM_BATCH_CHARS = 64
+
+
+def _coalesce_stream(chunks, batch_ms: int):
+    """Batch streamed fragments by count/size/time to cut per-chunk overhead."""
+    if not batch_ms:
+        yield from chunks
+        return
+    window = batch_ms / 1000.0
+    buf = []
+    buf_chars = 0
+    last_flush = time.monotonic()
+    for piece in chunks:
+        buf.append(piece)
+        buf_chars += len(piece)
+        now = time.monotonic()
+        if (
+            len(buf) >= _STREAM_BATCH_CHUNKS
+            or buf_chars >= _STREAM_BATCH_CHARS
+            or now - last_flush >= window
+        ):
+            yield "".join(buf)
+            buf.clear()
+            buf_chars = 0
+            last_flush = now
+    if buf:
+        yield "".join(buf)
+
+
+async def _acoalesce_stream(chunks, batch_ms: int):
+    """Async variant of _coalesce_stream."""
+    if not batch_ms:
+        async for piece in chunks:
+            yield piece
+        return
+    window = batch_ms / 1000.0
+    buf = []
+    buf_chars = 0
+    last_flush = time.monotonic()
+    async for piece in chunks:
+        buf.append(piece)
+        buf_chars += len(piece)
+        now = time.monotonic()
+        if (
+            len(buf) >= _STREAM_BATCH_CHUNKS
+            or buf_chars >= _STREAM_BATCH_CHARS
+            or now - last_flush >= window
+        ):
+            yield "".join(buf)
+            buf.clear()
+            buf_chars = 0
+            last_flush = now
+    if buf:
+        yield "".join(buf)
+
+
+# Transient failures worth retrying; anything else raises immediately.
+_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+_RETRY_ATTEMPTS = 5
+
+
+class _TokenBucket:
+    """Monotonic-clock token bucket shared by the sync and async paths."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take one token; return how long to wait before proceeding."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1.0
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Opt-in client-side rate limiting: set ZAI_RPM to a requests-per-minute
+# budget to shape traffic below the account quota instead of burning
+# attempts into 429 retries. Off by default.
+_RATE_LIMITER: Optional[_TokenBucket] = None
+_rate_limiter_read = False
+
+
+def _get_rate_limiter() -> Optional[_TokenBucket]:
+    global _RATE_LIMITER, _rate_limiter_read
+    if not _rate_limiter_read:
+        rpm = os.environ.get("ZAI_RPM")
+        if rpm:
+            try:
+                per_minute = int(rpm)
+            except ValueError:
+                per_minute = 0
+            # Non-positive values mean "disabled"; a zero-rate bucket would
+            # divide by zero when computing the wait time.
+            if per_minute > 0:
+                _RATE_LIMITER = _TokenBucket(per_minute)
+        _rate_limiter_read = True
+    return _RATE_LIMITER
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Backoff delay before the next attempt, honoring Retry-After."""
+    if retry_after:
+        try:
+            return min(float(retry_after), 30.0)
+        except ValueError:
+            pass
+    return min(0.5 * (2 ** attempt), 8.0) * random.uniform(0.5, 1.5)
+
+
+def _post_with_retries(url: str, headers: Dict[str, str], content: bytes) -> "httpx.Response":
+    """POST with exponential backoff on 429/5xx and network errors."""
+    import httpx
+
+    # Non-streaming calls get a bounded read so a hung response cannot wait
+    # forever (the shared client leaves reads unbounded for streaming).
+    timeout = httpx.Timeout(**{**_CLIENT_TIMEOUT_KWARGS, "read": 120.0})
+    limiter = _get_rate_limiter()
+    for attempt in range(_RETRY_ATTEMPTS):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = _get_client().post(
+                url, headers=headers, content=content, timeout=timeout
+            )
+            response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if status == 429 and _BALANCE_RX.search(e.response.text):
+                # An exhausted balance is not transient; retrying only
+                # delays the inevitable error.
+                _raise_for_status(status, e.response.text, e)
+            if status not in _RETRY_STATUS or attempt == _RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(_retry_delay(attempt, e.response.headers.get("Retry-After")))
+        except httpx.RequestError:
+            if attempt == _RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(_retry_delay(attempt))
+
+
+async def _apost_with_retries(url: str, headers: Dict[str, str], content: bytes) -> "httpx.Response":
+    """Async variant of _post_with_retries."""
+    import httpx
+
+    timeout = httpx.Timeout(**{**_CLIENT_TIMEOUT_KWARGS, "read": 120.0})
+    limiter = _get_rate_limiter()
+    for attempt in range(_RETRY_ATTEMPTS):
+        if limiter is not None:
+            await limiter.aacquire()
+        try:
+            response = await _get_async_client().post(
+                url, headers=headers, content=content, timeout=timeout
+            )
+            response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if status == 429 and _BALANCE_RX.search(e.response.text):
+                # An exhausted balance is not transient; fail fast.
+                _raise_for_status(status, e.response.text, e)
+            if status not in _RETRY_STATUS or attempt == _RETRY_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(_retry_delay(attempt, e.response.headers.get("Retry-After")))
+        except httpx.RequestError:
+            if attempt == _RETRY_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(_retry_delay(attempt))
+
+
+def _attachment_url(attachment) -> str:
+    """URL for an attachment, inlining local files as a data: URI."""
+    if attachment.url:
+        return attachment.url
+    return "data:{};base64,{}".format(
+        attachment.resolve_type(), attachment.base64_content()
+    )
+
+
+# Prebuilt messages for statuses with a specific translation; everything else
+# falls through to the 5xx / generic handling in _raise_for_status.
+_STATUS_ERRORS = {
+    401: "Invalid Z.ai API key",
+    429: "Rate limit exceeded. Please try again later.",
+}
+
+# Z.ai reports an exhausted balance as a 429; one compiled pattern covers the
+# English and Chinese phrasings in a single pass over the error body.
+_BALANCE_RX = re.compile(r"balance|recharge|充值", re.IGNORECASE)
+
+
+def _raise_for_status(status_code: int, text: str, cause: Optional[BaseException] = None):
+    """Raise the ValueError matching an HTTP error status from Z.ai."""
+    if status_code == 429 and text and _BALANCE_RX.search(text):
+        raise ValueError(
+            "Insufficient balance on your Z.ai account. Please recharge to continue."
+        ) from cause
+    message = _STATUS_ERRORS.get(status_code)
+    if message is None:
+        if status_code >= 500:
+            message = f"Z.ai server error: {status_code}"
+        else:
+            message = f"Z.ai API error: {text}"
+    raise ValueError(message) from cause
+
+
+class ZaiResponseCache:
+    """Exact-match response cache for deterministic (temperature=0) requests.
+
+    Keeps an in-memory LRU of parsed response payloads, optionally backed by
+    an on-disk diskcache store (set ZAI_CACHE_DIR and install the cache extra)
+    for reuse across processes.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._disk = None
+        path = os.environ.get("ZAI_CACHE_DIR")
+        if path:
+            try:
+                import diskcache
+            except ImportError:
+                pass
+            else:
+                self._disk = diskcache.Cache(path)
+
+    @staticmethod
+    def key_for(request_data: Dict[str, Any]) -> Optional[str]:
+        """Cache key for a request, or None if the request is not cacheable."""
+        if request_data.get("temperature") != 0:
+            return None
+        payload = json.dumps(request_data, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self._disk is not None:
+            return self._disk.get(key)
+        return None
+
+    def set(self, key: str, response_data: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = response_data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        if self._disk is not None:
+            self._disk.set(key, response_data)
+
+
+_RESPONSE_CACHE = ZaiResponseCache()
+
 
 class ZaiOptions(llm.Options):
     """Options for Z.ai models."""
@@ -30,6 +574,62 @@ class ZaiOptions(llm.Options):
         default=None,
     )
 
+    stream_batch_ms: Optional[int] = Field(
+        description="When streaming, coalesce chunks and flush every this many milliseconds. Set to 0 to yield every chunk immediately.",
+        ge=0,
+        default=None,
+    )
+
+
+# Per-option checks for the request hot path, mirroring the ZaiOptions
+# field constraints. ZaiOptions stays the declarative schema llm introspects
+# for -o / --option support; these avoid building a pydantic model per call.
+def _is_number(v) -> bool:
+    """True for int/float values, excluding bool (an int subclass)."""
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _is_int(v) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+_OPTION_CHECKS = {
+    "temperature": lambda v: _is_number(v) and 0 <= v <= 2,
+    "max_tokens": lambda v: _is_int(v),
+    "top_p": lambda v: _is_number(v) and 0 <= v <= 1,
+    "stream_batch_ms": lambda v: _is_int(v) and v >= 0,
+}
+
+
+def _validate_options(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate per-call options with direct checks instead of Pydantic."""
+    if not kwargs:
+        # The overwhelmingly common case: no options supplied at all.
+        return {}
+    options = {}
+    for name, value in kwargs.items():
+        check = _OPTION_CHECKS.get(name)
+        if check is None:
+            raise ValueError(f"Unknown option: {name}")
+        if value is None:
+            continue
+        if not check(value):
+            raise ValueError(f"Invalid value for option {name}: {value!r}")
+        options[name] = value
+    return options
+
+
+def _prompt_options(prompt) -> Dict[str, Any]:
+    """Options set on the prompt, as a plain dict of non-None values.
+
+    prompt.options is a ZaiOptions instance that llm already validated when
+    the prompt was built, so the values need no re-checking here.
+    """
+    opts = getattr(prompt, "options", None)
+    if opts is None:
+        return {}
+    return {k: v for k, v in opts if v is not None and k in _OPTION_CHECKS}
+
 
 class _ZaiShared:
     """Shared functionality for Z.ai models."""
@@ -37,14 +637,29 @@ class _ZaiShared:
     api_base = "https://api.z.ai/api/coding/paas/v4"
     needs_key = "zai"
     key_env_var = "ZAI_API_KEY"
+    # llm validates -o options against this class when building prompts.
+    Options = ZaiOptions
 
     def __init__(self, model_id: str):
         self.model_id = model_id
+        # Precomputed once; these never change for the lifetime of the instance.
+        self._api_model = model_id.replace("zai-", "").upper().replace("-AIR", "-Air")
+        self._chat_url = f"{self.api_base}/chat/completions"
+        self._payload_template = {"model": self._api_model}
+        self._cached_headers: Optional[Dict[str, str]] = None
+        self._cached_key_arg: Optional[str] = None
         super().__init__()
 
     def __str__(self):
         return "Z.ai: {}".format(self.model_id)
 
+    @property
+    def attachment_types(self):
+        """Image attachments are only accepted by the vision models."""
+        if self.model_id.endswith("v"):
+            return {"image/png", "image/jpeg", "image/webp", "image/gif"}
+        return set()
+
     def _get_api_key(self, key: Optional[str] = None) -> str:
         """Get the API key using LLM's native secrets management."""
         api_key = llm.get_key(key, alias=self.needs_key, env=self.key_env_var)
@@ -53,20 +668,67 @@ class _ZaiShared:
         return api_key
 
     def _get_headers(self, key: Optional[str] = None) -> Dict[str, str]:
-        """Get HTTP headers for API requests."""
-        api_key = self._get_api_key(key)
-        return {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-
-    def _build_request_data(self, messages: List[Dict[str, Any]], options: Dict[str, Any]) -> Dict[str, Any]:
-        """Build the request data for Z.ai API."""
-        return {
-            "model": self.model_id.replace("zai-", "").upper().replace("-AIR", "-Air"),
-            "messages": messages,
-            **options
-        }
+        """Per-request headers (cached per key argument).
+
+        Only Authorization varies per request; the static headers live on
+        the shared clients themselves. All model instances resolving the
+        same key share one header dict via _headers_for_key.
+        """
+        if self._cached_headers is None or key != self._cached_key_arg:
+            self._cached_headers = _headers_for_key(self._get_api_key(key))
+            self._cached_key_arg = key
+        return self._cached_headers
+
+    def _invalidate_headers(self):
+        """Drop cached auth headers so the next request re-resolves the key."""
+        self._cached_headers = None
+        self._cached_key_arg = None
+
+    def _build_request_data(self, messages: List[Dict[str, Any]], options: Dict[str, Any], stream: bool = False) -> Dict[str, Any]:
+        """Build the request data for Z.ai API in a single pass."""
+        payload = dict(self._payload_template)
+        payload["messages"] = messages
+        for k, v in options.items():
+            if k not in _INTERNAL_OPTIONS:
+                payload[k] = v
+        if stream:
+            payload["stream"] = True
+            # Ask for a final usage-bearing chunk so streamed responses get
+            # token counts without a follow-up request.
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _conversation_history(self, conversation) -> List[Dict[str, Any]]:
+        """Message dicts for a conversation's past turns, cached incrementally.
+
+        Keyed weakly on the conversation object; only turns added since the
+        last call are converted, so re-walking an N-turn chat costs O(new
+        turns) instead of O(N) per request.
+        """
+        responses = conversation.responses
+        try:
+            seen, prefix = _HISTORY_CACHE[conversation]
+        except (KeyError, TypeError):
+            seen, prefix = 0, []
+        if seen > len(responses):
+            # Conversation was truncated behind our back; rebuild from scratch.
+            seen, prefix = 0, []
+        if seen < len(responses):
+            new = []
+            for r in responses[seen:]:
+                if r.prompt:
+                    new.append({"role": "user", "content": r.prompt.prompt})
+                # Past turns are complete; text_or_raise returns their
+                # accumulated text without re-driving execution.
+                text = r.text_or_raise()
+                if text:
+                    new.append({"role": "assistant", "content": text})
+            prefix = prefix + new
+            try:
+                _HISTORY_CACHE[conversation] = (len(responses), prefix)
+            except TypeError:
+                pass  # conversation object is not weak-referenceable
+        return prefix
 
     def _extract_content(self, response_data: Dict[str, Any]) -> str:
         """Extract content from Z.ai response, handling reasoning_content field."""
@@ -80,6 +742,28 @@ class _ZaiShared:
 
         return content
 
+    def build_messages(self, prompt, conversation):
+        """Build messages for API request."""
+        messages = [{"role": "system", "content": prompt.system}] if prompt.system else []
+
+        if conversation:
+            messages += self._conversation_history(conversation)
+
+        # Add current prompt. The common text-only case stays a plain string;
+        # only build the multimodal content-parts list when attachments exist.
+        attachments = getattr(prompt, "attachments", None)
+        if attachments:
+            content = [{"type": "text", "text": prompt.prompt}]
+            content += (
+                {"type": "image_url", "image_url": {"url": _attachment_url(a)}}
+                for a in attachments
+            )
+            messages.append({"role": "user", "content": content})
+        else:
+            messages.append({"role": "user", "content": prompt.prompt})
+
+        return messages
+
     def _set_usage(self, response, usage: Dict[str, Any]):
         """Set usage information on response."""
         if usage:
@@ -92,59 +776,89 @@ class ZaiChat(_ZaiShared, KeyModel):
     """Synchronous Z.ai chat model."""
 
     model_id = "zai-glm-4.6"
-    can_stream = False
-
-    def build_messages(self, prompt, conversation):
-        """Build messages for API request."""
-        messages = []
-
-        # Add system message if provided
-        if prompt.system:
-            messages.append({"role": "system", "content": prompt.system})
-
-        # Add conversation history
-        if conversation:
-            for response in conversation.responses:
-                if response.prompt:
-                    messages.append({"role": "user", "content": response.prompt.prompt})
-                if response.response:
-                    messages.append({"role": "assistant", "content": response.response})
+    can_stream = True
 
-        # Add current prompt
-        messages.append({"role": "user", "content": prompt.prompt})
+    def _stream_chunks(self, request_data, response, key=None):
+        """Yield raw content deltas from a streaming request."""
+        import httpx
 
-        return messages
+        limiter = _get_rate_limiter()
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            with _get_client().stream(
+                "POST",
+                self._chat_url,
+                headers=self._get_headers(key),
+                content=_json_dumps(request_data),
+            ) as httpx_response:
+                if httpx_response.status_code >= 400:
+                    httpx_response.read()
+                    httpx_response.raise_for_status()
+                for data in _iter_sse_data(httpx_response.iter_bytes(chunk_size=4096)):
+                    content, usage = _parse_stream_payload(data)
+                    if usage:
+                        self._set_usage(response, usage)
+                    if content:
+                        yield content
+        except httpx.HTTPStatusError as e:
+            _raise_for_status(e.response.status_code, e.response.text, e)
+        except httpx.RequestError as e:
+            raise ValueError(f"Network error connecting to Z.ai: {str(e)}") from e
 
     def execute(self, prompt, stream, response, conversation=None, key=None, **kwargs):
         """Generate a response from the model."""
+        import httpx
+
         messages = self.build_messages(prompt, conversation or llm.Conversation(model=self))
-        options = ZaiOptions(**kwargs).model_dump(exclude_unset=True)
+        options = _prompt_options(prompt)
+        if kwargs:
+            options.update(_validate_options(kwargs))
+        batch_ms = options.get("stream_batch_ms")
+        if batch_ms is None:
+            batch_ms = 50
+
+        request_data = self._build_request_data(messages, options, stream=bool(stream))
 
-        # Remove unsupported options
-        request_options = {k: v for k, v in options.items() if k != "stream"}
+        if stream:
+            yield from _coalesce_stream(
+                self._stream_chunks(request_data, response, key), batch_ms
+            )
+            return
 
-        request_data = self._build_request_data(messages, request_options)
+        cache_key = _RESPONSE_CACHE.key_for(request_data)
+        if cache_key:
+            cached = _RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                response.response_json = cached
+                self._set_usage(response, cached.get("usage", {}))
+                content = self._extract_content(cached)
+                if content is not None:
+                    yield content
+                return
 
+        body = _json_dumps(request_data)
         try:
-            httpx_response = httpx.post(
-                f"{self.api_base}/chat/completions",
-                headers=self._get_headers(key),
-                json=request_data,
-                timeout=30.0
-            )
-            httpx_response.raise_for_status()
-            response_data = httpx_response.json()
+            try:
+                httpx_response = _post_with_retries(
+                    self._chat_url, self._get_headers(key), body
+                )
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 401:
+                    raise
+                # The cached key may have been rotated; re-resolve it once.
+                self._invalidate_headers()
+                httpx_response = _post_with_retries(
+                    self._chat_url, self._get_headers(key), body
+                )
+            response_data = _json_loads(httpx_response.content)
         except httpx.HTTPStatusError as e:
-            if e.response.status_code == 401:
-                raise ValueError("Invalid Z.ai API key")
-            elif e.response.status_code == 429:
-                raise ValueError("Rate limit exceeded. Please try again later.")
-            elif e.response.status_code >= 500:
-                raise ValueError(f"Z.ai server error: {e.response.status_code}")
-            else:
-                raise ValueError(f"Z.ai API error: {e.response.text}")
+            _raise_for_status(e.response.status_code, e.response.text, e)
         except httpx.RequestError as e:
-            raise ValueError(f"Network error connecting to Z.ai: {str(e)}")
+            raise ValueError(f"Network error connecting to Z.ai: {str(e)}") from e
+
+        if cache_key:
+            _RESPONSE_CACHE.set(cache_key, response_data)
 
         # Store response data and set usage
         response.response_json = response_data
@@ -160,51 +874,207 @@ class AsyncZaiChat(_ZaiShared, AsyncKeyModel):
     """Asynchronous Z.ai chat model."""
 
     model_id = "zai-glm-4.6"
-    can_stream = False
+    can_stream = True
 
-    def build_messages(self, prompt, conversation):
-        """Build messages for API request."""
-        messages = []
+    async def batch(self, prompts, max_concurrency: int = 10, rate_limit_per_min: Optional[int] = None, **kwargs):
+        """Run several prompts concurrently and return their response texts.
+
+        Dispatches up to max_concurrency requests at a time over the shared
+        connection pool. Results come back in prompt order; a failed prompt
+        yields its exception instead of aborting the whole batch. Pass
+        rate_limit_per_min to additionally shape traffic under a per-minute
+        quota (requires the aiolimiter package).
+        """
+        sem = asyncio.Semaphore(max_concurrency)
+        limiter = None
+        if rate_limit_per_min:
+            try:
+                from aiolimiter import AsyncLimiter
+            except ImportError:
+                raise ImportError(
+                    "rate_limit_per_min requires the aiolimiter package"
+                )
+            limiter = AsyncLimiter(rate_limit_per_min, 60)
 
-        # Add system message if provided
-        if prompt.system:
-            messages.append({"role": "system", "content": prompt.system})
+        async def one(p):
+            async with sem:
+                if limiter is not None:
+                    async with limiter:
+                        return await self.prompt(p, **kwargs).text()
+                return await self.prompt(p, **kwargs).text()
 
-        # Add current prompt
-        messages.append({"role": "user", "content": prompt.prompt})
+        return await asyncio.gather(*(one(p) for p in prompts), return_exceptions=True)
 
-        return messages
+    async def _aiohttp_post(self, url: str, json_data: Dict[str, Any], key=None) -> Dict[str, Any]:
+        """POST via the shared aiohttp session and return the parsed response."""
+        import aiohttp
+
+        session = _get_aiohttp_session()
+        body = _json_dumps(json_data)
+        limiter = _get_rate_limiter()
+        # Non-streaming calls get a bounded read so a hung response cannot
+        # wait forever (the shared session leaves reads unbounded).
+        timeout = aiohttp.ClientTimeout(total=None, connect=5.0, sock_read=120.0)
+        reauthed = False
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.aacquire()
+            try:
+                async with session.post(
+                    url, headers=self._get_headers(key), data=body, timeout=timeout
+                ) as resp:
+                    if resp.status >= 400:
+                        if resp.status == 401 and not reauthed:
+                            # The cached key may have been rotated;
+                            # re-resolve it once without spending an attempt.
+                            self._invalidate_headers()
+                            reauthed = True
+                            continue
+                        if resp.status in _RETRY_STATUS and attempt < _RETRY_ATTEMPTS - 1:
+                            text = await resp.text()
+                            if resp.status == 429 and _BALANCE_RX.search(text):
+                                # An exhausted balance is not transient.
+                                _raise_for_status(resp.status, text)
+                            await asyncio.sleep(
+                                _retry_delay(attempt, resp.headers.get("Retry-After"))
+                            )
+                            attempt += 1
+                            continue
+                        _raise_for_status(resp.status, await resp.text())
+                    return _json_loads(await resp.read())
+            except aiohttp.ClientError as e:
+                if attempt == _RETRY_ATTEMPTS - 1:
+                    raise ValueError(f"Network error connecting to Z.ai: {str(e)}") from e
+                await asyncio.sleep(_retry_delay(attempt))
+                attempt += 1
+
+    async def _aiohttp_stream(self, url: str, headers: Dict[str, str], json_data: Dict[str, Any], response=None):
+        """Stream SSE content deltas via the shared aiohttp session."""
+        import aiohttp
+
+        session = _get_aiohttp_session()
+        limiter = _get_rate_limiter()
+        if limiter is not None:
+            await limiter.aacquire()
+        try:
+            async with session.post(
+                url, headers=headers, data=_json_dumps(json_data)
+            ) as resp:
+                if resp.status >= 400:
+                    _raise_for_status(resp.status, await resp.text())
+                async for data in _aiter_sse_data(resp.content.iter_chunked(4096)):
+                    content, usage = _parse_stream_payload(data)
+                    if usage and response is not None:
+                        self._set_usage(response, usage)
+                    if content:
+                        yield content
+        except aiohttp.ClientError as e:
+            raise ValueError(f"Network error connecting to Z.ai: {str(e)}") from e
+
+    async def _stream_chunks(self, request_data, response, key=None):
+        """Yield raw content deltas from a streaming request."""
+        import httpx
+
+        limiter = _get_rate_limiter()
+        if limiter is not None:
+            await limiter.aacquire()
+        try:
+            async with _get_async_client().stream(
+                "POST",
+                self._chat_url,
+                headers=self._get_headers(key),
+                content=_json_dumps(request_data),
+            ) as httpx_response:
+                if httpx_response.status_code >= 400:
+                    await httpx_response.aread()
+                    httpx_response.raise_for_status()
+                async for data in _aiter_sse_data(
+                    httpx_response.aiter_bytes(chunk_size=4096)
+                ):
+                    content, usage = _parse_stream_payload(data)
+                    if usage:
+                        self._set_usage(response, usage)
+                    if content:
+                        yield content
+        except httpx.HTTPStatusError as e:
+            _raise_for_status(e.response.status_code, e.response.text, e)
+        except httpx.RequestError as e:
+            raise ValueError(f"Network error connecting to Z.ai: {str(e)}") from e
 
     async def execute(self, prompt, stream, response, conversation=None, key=None, **kwargs):
         """Generate an async response from the model."""
+        import httpx
+
         messages = self.build_messages(prompt, conversation or llm.AsyncConversation(model=self))
-        options = ZaiOptions(**kwargs).model_dump(exclude_unset=True)
+        options = _prompt_options(prompt)
+        if kwargs:
+            options.update(_validate_options(kwargs))
+        batch_ms = options.get("stream_batch_ms")
+        if batch_ms is None:
+            batch_ms = 50
+
+        request_data = self._build_request_data(messages, options, stream=bool(stream))
+
+        if stream:
+            if _use_aiohttp():
+                source = self._aiohttp_stream(
+                    self._chat_url, self._get_headers(key), request_data, response
+                )
+            else:
+                source = self._stream_chunks(request_data, response, key)
+            async for content in _acoalesce_stream(source, batch_ms):
+                yield content
+            return
 
-        # Remove unsupported options
-        request_options = {k: v for k, v in options.items() if k != "stream"}
+        cache_key = _RESPONSE_CACHE.key_for(request_data)
+        if cache_key:
+            cached = _RESPONSE_CACHE.get(cache_key)
+            if cached is not None:
+                response.response_json = cached
+                self._set_usage(response, cached.get("usage", {}))
+                content = self._extract_content(cached)
+                if content is not None:
+                    yield content
+                return
 
-        request_data = self._build_request_data(messages, request_options)
+        if _use_aiohttp():
+            response_data = await self._aiohttp_post(
+                self._chat_url,
+                request_data,
+                key,
+            )
+            if cache_key:
+                _RESPONSE_CACHE.set(cache_key, response_data)
+            response.response_json = response_data
+            self._set_usage(response, response_data.get("usage", {}))
+            content = self._extract_content(response_data)
+            if content is not None:
+                yield content
+            return
 
+        body = _json_dumps(request_data)
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                httpx_response = await client.post(
-                    f"{self.api_base}/chat/completions",
-                    headers=self._get_headers(key),
-                    json=request_data
+            try:
+                httpx_response = await _apost_with_retries(
+                    self._chat_url, self._get_headers(key), body
                 )
-                httpx_response.raise_for_status()
-                response_data = httpx_response.json()
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 401:
+                    raise
+                # The cached key may have been rotated; re-resolve it once.
+                self._invalidate_headers()
+                httpx_response = await _apost_with_retries(
+                    self._chat_url, self._get_headers(key), body
+                )
+            response_data = _json_loads(httpx_response.content)
         except httpx.HTTPStatusError as e:
-            if e.response.status_code == 401:
-                raise ValueError("Invalid Z.ai API key")
-            elif e.response.status_code == 429:
-                raise ValueError("Rate limit exceeded. Please try again later.")
-            elif e.response.status_code >= 500:
-                raise ValueError(f"Z.ai server error: {e.response.status_code}")
-            else:
-                raise ValueError(f"Z.ai API error: {e.response.text}")
+            _raise_for_status(e.response.status_code, e.response.text, e)
         except httpx.RequestError as e:
-            raise ValueError(f"Network error connecting to Z.ai: {str(e)}")
+            raise ValueError(f"Network error connecting to Z.ai: {str(e)}") from e
+
+        if cache_key:
+            _RESPONSE_CACHE.set(cache_key, response_data)
 
         # Store response data and set usage
         response.response_json = response_data
@@ -216,44 +1086,41 @@ class AsyncZaiChat(_ZaiShared, AsyncKeyModel):
             yield content
 
 
-@hookimpl
-def register_models(register):
-    """Register Z.ai models with the LLM tool."""
+def _prewarm():
+    """Establish DNS + TLS for api.z.ai ahead of the first real request."""
+    try:
+        _get_client().head(_ZaiShared.api_base, timeout=5.0)
+    except Exception:
+        # Best effort only; the first real request pays the cost instead.
+        pass
 
-    # GLM-4.6 - Latest text model
-    register(
-        ZaiChat("zai-glm-4.6"),
-        AsyncZaiChat("zai-glm-4.6"),
-        aliases=["glm-4.6"],
-    )
 
-    # GLM-4.5V - Vision model
-    register(
-        ZaiChat("zai-glm-4.5v"),
-        AsyncZaiChat("zai-glm-4.5v"),
-        aliases=["glm-4.5v"],
-    )
+# Registered models as (model_id, aliases) pairs.
+_MODELS = (
+    ("zai-glm-4.6", ("glm-4.6",)),  # Latest text model
+    ("zai-glm-4.5v", ("glm-4.5v",)),  # Vision model
+    ("zai-glm-4.5", ("glm-4.5",)),  # Standard text model
+    ("zai-glm-4.5-air", ("glm-4.5-air",)),  # Lightweight text model
+    ("zai-glm-4-32b", ("glm-4-32b", "glm-4-32b-0414-128k")),  # Large context model
+)
 
-    # GLM-4.5 - Standard text model
-    register(
-        ZaiChat("zai-glm-4.5"),
-        AsyncZaiChat("zai-glm-4.5"),
-        aliases=["glm-4.5"],
-    )
 
-    # GLM-4.5-Air - Lightweight text model
-    register(
-        ZaiChat("zai-glm-4.5-air"),
-        AsyncZaiChat("zai-glm-4.5-air"),
-        aliases=["glm-4.5-air"],
-    )
+@hookimpl
+def register_models(register):
+    """Register Z.ai models with the LLM tool."""
 
-    # GLM-4-32b-0414-128K - Large context model
-    register(
-        ZaiChat("zai-glm-4-32b"),
-        AsyncZaiChat("zai-glm-4-32b"),
-        aliases=["glm-4-32b", "glm-4-32b-0414-128k"],
-    )
+    # Opt-in connection pre-warm: moves the one-time DNS + TLS handshake off
+    # the critical path of the first prompt. Off by default because model
+    # registration runs on every CLI invocation.
+    if os.environ.get("ZAI_PREWARM"):
+        threading.Thread(target=_prewarm, daemon=True).start()
+
+    for model_id, aliases in _MODELS:
+        register(
+            ZaiChat(model_id),
+            AsyncZaiChat(model_id),
+            aliases=list(aliases),
+        )
 
 
-__all__ = ["ZaiChat", "AsyncZaiChat", "ZaiOptions", "register_models"]
\ No newline at end of file
+__all__ = ["ZaiChat", "AsyncZaiChat", "ZaiOptions", "register_models", "aclose"]
\ No newline at end of file